@@ -1,81 +1,590 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import re
+import json
+import hashlib
+import logging
+import threading
+import orjson
+import diskcache
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from streamlit.errors import StreamlitAPIException
 
 # -----------------
 # CONFIG & KEYS
 # -----------------
-load_dotenv()
-API_KEY = st.secrets.get("OPENROUTER_API_KEY") or os.getenv("OPENROUTER_API_KEY")
+@st.cache_resource
+def get_api_key():
+    """Resolve the OpenRouter key once per process: Streamlit secrets first, then the environment.
+
+    `.env` is only read when secrets don't provide the key, so production deployments never
+    touch it. A missing key raises instead of returning None, so it is not cached and a key
+    added later is picked up on the next rerun.
+    """
+    try:
+        key = st.secrets.get("OPENROUTER_API_KEY")
+    except FileNotFoundError:  # no secrets.toml at all, e.g. local runs configured via .env
+        key = None
+    if not key:
+        load_dotenv()
+        key = os.getenv("OPENROUTER_API_KEY")
+    if not key:
+        raise KeyError("OPENROUTER_API_KEY")
+    return key
+
 MODEL = "openai/gpt-oss-20b:free"
+# Small model for short classification/paraphrase tasks (answer checks, hints)
+MODEL_FAST = "meta-llama/llama-3.2-3b-instruct:free"
 API_URL = "https://openrouter.ai/api/v1/chat/completions"
+API_ERROR = "❌ Error contacting API"
+# Fail fast on connections that never open; read timeouts are passed per call.
+CONNECT_TIMEOUT = 5
+LLM_CACHE_DIR = ".llm_cache"
+LLM_CACHE_TTL = 86400
 
-if not API_KEY:
+logger = logging.getLogger(__name__)
+EMBED_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_SIZE = 200
+# Answer checks add a scope per (lesson, question), so the number of scopes is capped too
+SEMANTIC_CACHE_SCOPES = 500
+# Lessons kept per session so Easier/Harder toggling doesn't regenerate them
+TUTORIAL_CACHE_SIZE = 16
+# Answer checks only go to the LLM when the student's answer is neither clearly
+# close to nor clearly far from the reference answer.
+ANSWER_MATCH_THRESHOLD = 0.85
+ANSWER_MISMATCH_THRESHOLD = 0.25
+# Stricter than SEMANTIC_CACHE_THRESHOLD: a reused verdict is graded, not just displayed
+CHECK_CACHE_THRESHOLD = 0.93
+
+# Output caps: decode time grows with every generated token. The tutorial cap leaves
+# headroom for the reasoning tokens gpt-oss spends before answering.
+TUTORIAL_MAX_TOKENS = 800
+HINT_MAX_TOKENS = 64
+CHECK_MAX_TOKENS = 48
+
+try:
+    API_KEY = get_api_key()
+except KeyError:
     st.error("API key not found. Please set OPENROUTER_API_KEY in Streamlit secrets or environment.")
     st.stop()
 
 # -----------------
 # UTILITIES
 # -----------------
-def ask_openrouter(prompt, timeout=60):
-    """Send a prompt to the OpenRouter API and return the model's text reply."""
-    headers = {
+@st.cache_resource
+def get_http_session():
+    """Shared keep-alive session so every OpenRouter call reuses a pooled TCP+TLS connection."""
+    session = requests.Session()
+    session.headers.update({
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
+    })
+    # Transient 429/5xx responses (common on the :free tier) and connection errors are
+    # retried with exponential backoff, honouring Retry-After. Once retries run out the
+    # last response is returned as-is, so callers' raise_for_status reports its status.
+    # Read timeouts are not retried here (read=False re-raises them as ReadTimeout):
+    # post_completion() gives a hung read exactly one second chance, and every retry
+    # re-submits a billed generation.
+    retry = Retry(
+        total=3,
+        read=False,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    # One session serves every user of this process plus the prefetch workers, so keep
+    # enough idle connections per host that concurrent calls don't discard and redial them.
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry))
+    return session
+
+def post_completion(payload, timeout, stream=False):
+    """POST a chat-completion payload; a read timeout is retried once with double the budget."""
+    session = get_http_session()
+    data = orjson.dumps(payload)
+    try:
+        return session.post(API_URL, data=data, timeout=(CONNECT_TIMEOUT, timeout), stream=stream)
+    except requests.exceptions.ReadTimeout:
+        return session.post(API_URL, data=data, timeout=(CONNECT_TIMEOUT, 2 * timeout), stream=stream)
+
+@st.cache_resource
+def get_executor():
+    """Process-wide worker pool for speculative LLM calls that run while the user is reading."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def build_messages(prompt, context=None):
+    """Build the chat messages, putting shared `context` (e.g. the tutorial) in a cacheable system prefix.
+
+    Keeping the long, repeated text in an identical leading message lets the provider reuse
+    its prefill (prompt caching) across the quiz, hint and answer-check calls for one lesson.
+    """
+    messages = []
+    if context:
+        messages.append({
+            "role": "system",
+            "content": [{"type": "text", "text": context, "cache_control": {"type": "ephemeral"}}]
+        })
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def tutorial_context(lesson):
+    return (
+        "=== TUTORIAL START ===\n"
+        f"{lesson}\n"
+        "=== TUTORIAL END ==="
+    )
+
+@st.cache_resource
+def get_disk_cache():
+    """On-disk LLM reply cache that survives restarts and is shared by every process on the host."""
+    return diskcache.Cache(LLM_CACHE_DIR)
+
+@st.cache_resource
+def get_disk_cache_stats():
+    """Process-wide hit/miss counters for the disk cache only.
+
+    Replies served by the st.cache_data layer never reach the disk lookup, so they are not
+    counted here. Prefetch workers update the counters too, hence the lock.
+    """
+    return {"hits": 0, "misses": 0, "lock": threading.Lock()}
+
+@st.cache_data(ttl=LLM_CACHE_TTL, max_entries=500, show_spinner=False)
+def cached_ask(prompt, model, max_tokens=None, context=None, _timeout=60):
+    """Return the model's reply to a prompt, cached per (prompt, model) across sessions.
+
+    Misses in the in-memory cache fall through to the disk cache, keyed by a hash of the
+    full request payload, before calling the API. Errors are raised rather than returned
+    so that failed calls are never cached.
+    """
+    payload = {
+        "model": model,
+        "messages": build_messages(prompt, context)
     }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    data = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    key = hashlib.sha256(data).hexdigest()
+    disk_cache = get_disk_cache()
+    stats = get_disk_cache_stats()
+    reply = disk_cache.get(key)
+    with stats["lock"]:
+        stats["hits" if reply is not None else "misses"] += 1
+        hits, misses = stats["hits"], stats["misses"]
+    if reply is not None:
+        logger.debug("LLM disk cache hit (%d hits / %d misses)", hits, misses)
+        return reply
+    resp = post_completion(payload, _timeout)
+    resp.raise_for_status()
+    reply = orjson.loads(resp.content)["choices"][0]["message"]["content"]
+    disk_cache.set(key, reply, expire=LLM_CACHE_TTL)
+    return reply
+
+def ask_openrouter(prompt, model=MODEL, max_tokens=None, context=None, timeout=60):
+    """Send a prompt to the OpenRouter API and return the model's text reply."""
+    try:
+        return cached_ask(prompt, model, max_tokens, context, timeout)
+    except Exception as e:
+        return f"{API_ERROR}: {e}"
+
+def ask_many(prompts, contexts=None, **kwargs):
+    """Send independent prompts concurrently and return the replies in order.
+
+    `contexts` optionally gives each prompt its own context; other keyword arguments apply
+    to every call. Uses its own short-lived pool rather than get_executor(), so it is safe
+    to call from a prefetch task already running on that pool.
+    """
+    if not prompts:
+        return []
+    if contexts is None:
+        contexts = [kwargs.pop("context", None)] * len(prompts)
+    with ThreadPoolExecutor(max_workers=min(8, len(prompts))) as pool:
+        return list(pool.map(lambda prompt, context: ask_openrouter(prompt, context=context, **kwargs),
+                             prompts, contexts))
+
+def ask_openrouter_stream(prompt, max_tokens=None, timeout=60):
+    """Stream the model's reply from the OpenRouter API, yielding text chunks as they arrive.
+
+    Closing the generator early (e.g. the user closes the tab or stops the script run
+    mid-stream) closes the HTTP response, so the provider stops generating.
+    """
     payload = {
         "model": MODEL,
-        "messages": [{"role": "user", "content": prompt}]
+        "messages": build_messages(prompt),
+        "stream": True
     }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
     try:
-        resp = requests.post(API_URL, headers=headers, json=payload, timeout=timeout)
-        resp.raise_for_status()
-        return resp.json()["choices"][0]["message"]["content"]
+        with post_completion(payload, timeout, stream=True) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                # SSE frames look like b"data: {...}"; blank lines and b": comment" keep-alives are skipped
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = orjson.loads(data)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"].get("message", chunk["error"]))
+                choices = chunk.get("choices") or [{}]
+                text = choices[0].get("delta", {}).get("content")
+                if text:
+                    yield text
     except Exception as e:
-        return f"❌ Error contacting API: {e}"
+        yield f"{API_ERROR}: {e}"
+
+_CODE_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$')
+_JSON_DECODER = json.JSONDecoder()
+_JSON_OBJECT_RE = re.compile(r'\{[^{}]*\}')
+_SECTION_RE = re.compile(r'^(?=#{1,6}\s)', re.M)
+_HEADING_LINE_RE = re.compile(r'^#{1,6}\s.*$', re.M)
+_WORD_RE = re.compile(r'\w+')
+# Question words and fillers that say nothing about which section a question is about
+_STOPWORDS = frozenset(
+    "the and are was were for from with that this these those its their what which who whom whose "
+    "when where why how does did can could would should will has have had not but you your about "
+    "into than then there also some any all each one more most many much name give state explain "
+    "describe called".split()
+)
+
+def keywords(text):
+    """Lower-cased content words of `text`, without stopwords and tokens under 3 characters."""
+    return {word for word in _WORD_RE.findall(text.lower()) if len(word) > 2 and word not in _STOPWORDS}
+
+def relevant_section(lesson, question):
+    """Return the Markdown section of the lesson that covers most of `question`'s keywords.
+
+    Sections are split on headings; a heading with no body of its own (e.g. the title) is
+    merged into the section that follows it, so every candidate has content. Sections are
+    scored by the share of the question's keywords they contain, which unlike Jaccard
+    doesn't favour short sections, and stopwords are ignored so "What is ..." doesn't pick
+    a section for its wording. Falls back to the whole lesson when it has fewer than two
+    sections or nothing overlaps.
+    """
+    sections, carried = [], ""
+    for chunk in _SECTION_RE.split(lesson):
+        chunk = carried + chunk
+        if _HEADING_LINE_RE.sub('', chunk).strip():
+            sections.append(chunk)
+            carried = ""
+        else:
+            carried = chunk
+    q_words = keywords(question)
+    if len(sections) < 2 or not q_words:
+        return lesson
+    best_score, best_section = 0.0, lesson
+    for section in sections:
+        score = len(q_words & keywords(section)) / len(q_words)
+        if score > best_score:
+            best_score, best_section = score, section
+    return best_section
+
+def load_json_array(text):
+    """Decode a JSON array from a model reply (optionally inside a code fence); [] if it isn't one.
+
+    Models sometimes wrap the array in prose, so on a parse failure the array starting at
+    the first '[' is decoded on its own, ignoring whatever follows it (brackets included).
+    """
+    cleaned = _CODE_FENCE_RE.sub('', text.strip())
+    try:
+        items = orjson.loads(cleaned)
+    except ValueError:
+        start = cleaned.find("[")
+        if start == -1:
+            return []
+        try:
+            items, _ = _JSON_DECODER.raw_decode(cleaned, start)
+        except ValueError:
+            return []
+    return items if isinstance(items, list) else []
+
+def load_json_objects(text):
+    """Decode every flat {...} object that parses on its own, skipping the broken ones.
+
+    Salvages the usable items from a reply whose array as a whole is malformed or
+    was cut off by the token limit.
+    """
+    items = []
+    for match in _JSON_OBJECT_RE.finditer(text):
+        try:
+            items.append(orjson.loads(match.group(0)))
+        except ValueError:
+            continue
+    return items
+
+def parse_quiz(text):
+    """Parse the model's JSON quiz reply into parallel lists of at most 10 questions and answers.
+
+    If fewer than 8 items come out of the array, the individual objects are salvaged instead.
+    """
+    items = load_json_array(text)
+    if len(items) < 8:
+        salvaged = load_json_objects(text)
+        if len(salvaged) > len(items):
+            items = salvaged
+    questions, answers = [], []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        # Questions are taken verbatim: a leading number may be part of it ("2 + 2 equals what?").
+        question, answer = item.get("question"), item.get("answer")
+        if not isinstance(question, str) or not isinstance(answer, str):
+            continue
+        question, answer = question.strip(), answer.strip()
+        if question and answer and answer.lower() != "insufficient":
+            questions.append(question)
+            answers.append(answer)
+            if len(questions) == 10:
+                break
+    return questions, answers
+
+def parse_hints(text, count):
+    """Parse a JSON array of per-question hint lists, padded or truncated to `count` questions."""
+    hints = []
+    for item in load_json_array(text)[:count]:
+        if not isinstance(item, list):
+            item = []
+        hints.append([str(h).strip() for h in item if str(h).strip()][:3])
+    return hints + [[] for _ in range(count - len(hints))]
 
-def strip_numbering(line):
-    return re.sub(r'^\s*\d+\s*[\).\:-]?\s*', '', line).strip()
+# -----------------
+# SEMANTIC CACHE
+# -----------------
+@st.cache_resource(show_spinner=False)
+def get_embedder():
+    """Load the sentence-embedding model once per process, or None if it isn't available.
+
+    The import lives here because sentence-transformers pulls in torch (seconds of cold
+    start); pages that never embed anything don't pay for it. A model that fails to load
+    (e.g. an offline host that can't download it) also yields None, so the semantic
+    features are skipped rather than crashing the page; restart the app to retry.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:  # optional: semantic features are skipped without it
+        return None
+    try:
+        return SentenceTransformer(EMBED_MODEL)
+    except Exception:
+        logger.exception("Could not load embedding model %s; semantic features are disabled", EMBED_MODEL)
+        return None
+
+def embed(texts):
+    """Unit-length embeddings for a string or list of strings, or None without an embedder.
+
+    Vectors are normalized so cosine similarity is a plain dot product.
+    """
+    embedder = get_embedder()
+    if embedder is None:
+        return None
+    return embedder.encode(texts, normalize_embeddings=True)
+
+@st.cache_resource
+def get_semantic_store():
+    """Process-wide LRU of {scope: [(embedding, response), ...]} shared by all sessions.
+
+    Sessions and prefetch workers read and update it concurrently, hence the lock.
+    """
+    return {"scopes": OrderedDict(), "lock": threading.Lock()}
+
+def semantic_lookup(scope, text, threshold=SEMANTIC_CACHE_THRESHOLD, emb=None):
+    """Return a stored response whose key text is a near-duplicate of `text` within `scope`, else None.
+
+    `scope` must hold everything that has to match exactly (model, subject, grade, ...);
+    only the free-text part is compared by embedding similarity. Pass `emb` if `text`
+    has already been embedded.
+    """
+    store = get_semantic_store()
+    with store["lock"]:
+        entries = store["scopes"].get(scope)
+        if entries:
+            store["scopes"].move_to_end(scope)
+    if not entries:
+        return None
+    if emb is None:
+        emb = embed(text)
+    if emb is None:
+        return None
+    best_sim, best_response = max(((float(emb @ stored), response) for stored, response in entries),
+                                  key=lambda pair: pair[0])
+    return best_response if best_sim >= threshold else None
+
+def semantic_store(scope, text, response, threshold=SEMANTIC_CACHE_THRESHOLD, emb=None):
+    """Remember `response` for `text` within `scope`, replacing any near-duplicate entry."""
+    if emb is None:
+        emb = embed(text)
+    if emb is None:
+        return
+    store = get_semantic_store()
+    with store["lock"]:
+        scopes = store["scopes"]
+        entries = [(stored, old) for stored, old in scopes.get(scope, [])
+                   if float(emb @ stored) < threshold]
+        entries.append((emb, response))
+        scopes[scope] = entries[-SEMANTIC_CACHE_SIZE:]
+        scopes.move_to_end(scope)
+        if len(scopes) > SEMANTIC_CACHE_SCOPES:
+            scopes.popitem(last=False)
 
 # -----------------
 # STRICT LLM HELPERS
 # -----------------
-def check_answer_with_llm(question, student_answer):
+def check_answer_with_llm(lesson, question, student_answer, reference_answer="", reference_emb=None):
+    # reference_emb is precomputed at quiz creation, so a submit only embeds the student's answer.
+    student_emb = embed(student_answer)
+    if student_emb is not None and reference_answer:
+        if reference_emb is None:
+            reference_emb = embed(reference_answer)
+        sim = float(student_emb @ reference_emb)
+        if sim >= ANSWER_MATCH_THRESHOLD:
+            return True, "CORRECT\nYour answer matches the tutorial."
+        if sim <= ANSWER_MISMATCH_THRESHOLD:
+            return False, "INCORRECT\nYour answer doesn't match the tutorial. Try re-reading the relevant section."
+
+    # Verdicts are shared across sessions for near-identical answers to the same question on the same lesson.
+    scope = ("check", MODEL_FAST, hashlib.sha256(f"{lesson}\0{question}".encode()).hexdigest())
+    cached = semantic_lookup(scope, student_answer, CHECK_CACHE_THRESHOLD, student_emb)
+    if cached is not None:
+        return cached
+
     prompt = (
         "You are an examiner. Determine if the student's answer is correct "
-        "STRICTLY based on the tutorial below. Ignore outside knowledge. "
+        "STRICTLY based on the tutorial above. Ignore outside knowledge. "
         "Reply with a single word 'CORRECT' or 'INCORRECT' at the start, "
         "followed by one short sentence of feedback. Do NOT reveal the correct answer.\n\n"
-        "=== TUTORIAL START ===\n"
-        f"{st.session_state.lesson}\n"
-        "=== TUTORIAL END ===\n\n"
         f"Question: {question}\n"
         f"Student Answer: {student_answer}\n"
     )
-    resp = ask_openrouter(prompt)
+    resp = ask_openrouter(prompt, model=MODEL_FAST, max_tokens=CHECK_MAX_TOKENS,
+                          context=tutorial_context(lesson))
     if isinstance(resp, str):
-        first_line = resp.strip().splitlines()[0].strip().lower()
-        if first_line.startswith("correct"):
-            return True, resp
-        else:
-            return False, resp
+        # Only the first line carries the verdict; don't split the whole reply to read it.
+        resp = resp.strip()
+        first_nl = resp.find("\n")
+        head = (resp[:first_nl] if first_nl != -1 else resp).strip()
+        verdict = (head[:7].casefold() == "correct", resp)
+        if API_ERROR not in resp:
+            semantic_store(scope, student_answer, verdict, CHECK_CACHE_THRESHOLD, student_emb)
+        return verdict
     return False, str(resp)
 
-def generate_hint(question, answer_text):
-    prompt = (
+def hint_prompt(question, answer_text, hint_number=1):
+    # The hint number is part of the prompt so cached replies still get progressively stronger.
+    return (
         "You are a helpful tutor. Provide a short hint that nudges the student toward the answer "
-        "without revealing it. Use ONLY the information in the tutorial. "
-        "Do not add new facts.\n\n"
-        "=== TUTORIAL START ===\n"
-        f"{st.session_state.lesson}\n"
-        "=== TUTORIAL END ===\n\n"
+        "without revealing it. Use ONLY the information in the tutorial above. "
+        "Do not add new facts. "
+        f"This is hint {hint_number} of 3; make it more specific than any earlier hints.\n\n"
         f"Question: {question}\n"
         f"(For your reference only) Answer: {answer_text}\n"
+        "Respond with one short sentence.\n"
         "Hint:"
     )
-    return ask_openrouter(prompt)
+
+def generate_hint(lesson, question, answer_text, hint_number=1):
+    # Hints only need the part of the lesson the question is about.
+    return ask_openrouter(hint_prompt(question, answer_text, hint_number), model=MODEL_FAST,
+                          max_tokens=HINT_MAX_TOKENS, context=tutorial_context(relevant_section(lesson, question)))
+
+def generate_quiz(lesson, subject, grade, concept):
+    """Generate the quiz questions and their answers in a single round-trip.
+
+    A reply that still yields fewer than 8 items after local repair gets one stricter
+    reprompt; the longer of the two quizzes is kept. Returns parallel question and answer lists.
+    """
+    prompt = (
+        "You are a careful examiner. Generate exactly 10 quiz questions with their answers. "
+        "CRITICAL RULES: Questions must be answerable directly and exclusively from the tutorial above; "
+        "answers must be found verbatim or paraphrased from the tutorial; "
+        "do not use outside knowledge; do not invent facts. "
+        "If an answer cannot be derived strictly from the tutorial, use 'INSUFFICIENT' as the answer. "
+        f"Context: Subject={subject}, Grade={grade}, Topic='{concept}'. "
+        'Return ONLY a JSON array of objects with keys "question" and "answer", '
+        "with no numbering. Each question must be at most 20 words and each answer at most 10 words."
+    )
+    context = tutorial_context(lesson)
+    reply = ask_openrouter(prompt, context=context)
+    quiz = parse_quiz(reply)
+    if len(quiz[0]) < 8 and API_ERROR not in reply:
+        retry = parse_quiz(ask_openrouter(
+            prompt + " Return JSON only: no prose, no code fences, nothing before '[' or after ']'.",
+            context=context
+        ))
+        if len(retry[0]) > len(quiz[0]):
+            quiz = retry
+    return quiz
+
+def generate_hints(lesson, questions, answers):
+    """Generate three progressively stronger hints for every quiz question in one call.
+
+    Returns None if the call itself failed, so callers can tell that apart from a reply
+    that skipped some questions.
+    """
+    listing = "\n".join(
+        f"{i}. Question: {q} (For your reference only) Answer: {a}"
+        for i, (q, a) in enumerate(zip(questions, answers), 1)
+    )
+    prompt = (
+        "You are a helpful tutor. For each question below, write 3 hints that get progressively "
+        "more specific and nudge the student toward the answer without ever revealing it. "
+        "Use ONLY the information in the tutorial above. Do not add new facts. "
+        "Each hint must be one short sentence. "
+        "Return ONLY a JSON array with one [hint1, hint2, hint3] array per question, in the same order.\n\n"
+        f"{listing}"
+    )
+    reply = ask_openrouter(prompt, model=MODEL_FAST, context=tutorial_context(lesson))
+    if API_ERROR in reply:
+        return None
+    return parse_hints(reply, len(questions))
+
+def quiz_state(questions=(), answers=(), hints=(), answer_embs=None):
+    """Session-state entries for a quiz, kept as parallel per-question lists indexed by question number."""
+    return {
+        "quiz_q": list(questions),
+        "quiz_a": list(answers),
+        "quiz_hints": list(hints),
+        "quiz_emb": answer_embs,
+        "hints_used": [0] * len(questions)
+    }
+
+def prepare_quiz(lesson, subject, grade, concept):
+    """Build the quiz with precomputed hints and answer embeddings, so Hint and Submit skip that work.
+
+    Returns the quiz_state() entries, ready for st.session_state.update().
+    """
+    questions, answers = generate_quiz(lesson, subject, grade, concept)
+    if not questions:
+        return quiz_state()
+    hints = generate_hints(lesson, questions, answers)
+    if hints is None:
+        # The batch call failed, typically rate-limited on the :free tier. Fanning out one
+        # call per question would only pile more requests onto that limit, so every hint
+        # is left to be generated on demand.
+        hints = [[] for _ in questions]
+    else:
+        # Questions the batch reply left without hints get their first hint fetched
+        # concurrently now, as the same request generate_hint() would send, so the two
+        # share cache entries; later hints for them are still generated on demand.
+        missing = [i for i, h in enumerate(hints) if not h]
+        first_hints = ask_many(
+            [hint_prompt(questions[i], answers[i]) for i in missing],
+            contexts=[tutorial_context(relevant_section(lesson, questions[i])) for i in missing],
+            model=MODEL_FAST, max_tokens=HINT_MAX_TOKENS
+        )
+        for i, hint in zip(missing, first_hints):
+            if API_ERROR not in hint:
+                hints[i] = [hint]
+    # One (n, dim) matrix instead of a vector per question; None without an embedder.
+    return quiz_state(questions, answers, hints, embed(answers))
 
 # -----------------
 # SESSION STATE INIT
@@ -85,189 +594,304 @@ defaults = {
     "lesson": "",
     "subject": "",
     "concept": "",
-    "quiz": [],
+    **quiz_state(),
     "current_q": 0,
     "score": 0,
-    "hints_used": {},
     "difficulty_grade": 6,
     "quiz_feedback": None,
-    "last_tutorial_signature": None
+    "last_tutorial_signature": None,
+    "regenerate_tutorial": False,
+    "quiz_future": None,
+    "in_flight": False,
+    "pending": None,
+    "tutorial_cache": OrderedDict()
 }
-for k, v in defaults.items():
-    if k not in st.session_state:
-        st.session_state[k] = v
+# All defaults are written together on a session's first run, so one membership
+# check covers every later rerun.
+if "page" not in st.session_state:
+    st.session_state.update(defaults)
+
+def start_llm_call(action):
+    """Flag an LLM call as in flight from a button's on_click callback.
+
+    Callbacks run before the script, so the run that makes the call renders every trigger
+    button disabled and a second click can't queue a duplicate request. Because Streamlit
+    drops clicks on a widget that renders disabled, the script acts on the `pending` action
+    rather than on the button's return value, inside handling_llm_call().
+    """
+    st.session_state.in_flight = True
+    st.session_state.pending = action
+
+@contextmanager
+def handling_llm_call(scope="app"):
+    """Handle a flagged LLM call, then clear the flag and rerun so the trigger buttons render enabled again.
+
+    The flag is cleared in a `finally`, so a call that raises can't leave the buttons
+    disabled for the rest of the session; the error then propagates instead of the rerun.
+    """
+    try:
+        yield
+    finally:
+        st.session_state.in_flight = False
+        st.session_state.pending = None
+    try:
+        st.rerun(scope=scope)
+    except StreamlitAPIException:
+        # scope="fragment" is rejected when the fragment is running as part of a full-app
+        # run (a manual rerun, or a reconnect mid-call), so rerun the whole app instead.
+        st.rerun()
 
 # -----------------
 # TUTORIAL SYNC (ROBUST AUTO REGENERATION)
 # -----------------
-def ensure_tutorial_uptodate():
+def ensure_tutorial_uptodate(placeholder):
+    """Regenerate the lesson if the settings changed, streaming it into `placeholder` as it arrives.
+
+    Lessons this session already saw for the same settings come from a small per-session LRU,
+    and near-duplicate concepts for the same subject and grade from the semantic cache;
+    both are skipped when the user explicitly asked for a better tutorial.
+    """
     sig = (st.session_state.subject, st.session_state.concept, st.session_state.difficulty_grade)
     if st.session_state.get("last_tutorial_signature") != sig and st.session_state.subject and st.session_state.concept:
-        with st.spinner("Updating tutorial for the new settings..."):
-            st.session_state.lesson = ask_openrouter(
-                f"You are an expert {st.session_state.subject} teacher for Grade {st.session_state.difficulty_grade}."
-                f" Create a clear, structured tutorial for the topic '{st.session_state.concept}'."
-                f" The tutorial must be entirely self-contained and sufficient for answering basic conceptual questions."
-                f" Include short sections with headings, key definitions, examples, and a brief summary."
-                f" Keep language age-appropriate for Grade {st.session_state.difficulty_grade} in India."
-            )
+        scope = ("tutorial", MODEL, st.session_state.subject, st.session_state.difficulty_grade)
+        fresh = st.session_state.regenerate_tutorial
+        st.session_state.regenerate_tutorial = False
+        tutorial_cache = st.session_state.tutorial_cache
+        lesson = None if fresh else tutorial_cache.get(sig)
+        if lesson is None and not fresh:
+            lesson = semantic_lookup(scope, st.session_state.concept)
+        if lesson is None:
+            with st.spinner("Updating tutorial for the new settings..."):
+                lesson = placeholder.write_stream(ask_openrouter_stream(
+                    f"You are an expert {st.session_state.subject} teacher for Grade {st.session_state.difficulty_grade}."
+                    f" Create a clear, structured tutorial for the topic '{st.session_state.concept}'."
+                    f" The tutorial must be entirely self-contained and sufficient for answering basic conceptual questions."
+                    f" Include short sections with headings, key definitions, examples, and a brief summary."
+                    f" Keep language age-appropriate for Grade {st.session_state.difficulty_grade} in India."
+                    f" Keep the entire tutorial under 250 words.",
+                    max_tokens=TUTORIAL_MAX_TOKENS
+                )) or ""
+            if lesson and API_ERROR not in lesson:
+                semantic_store(scope, st.session_state.concept, lesson)
+        if lesson and API_ERROR not in lesson:
+            tutorial_cache[sig] = lesson
+            tutorial_cache.move_to_end(sig)
+            if len(tutorial_cache) > TUTORIAL_CACHE_SIZE:
+                tutorial_cache.popitem(last=False)
+        st.session_state.lesson = lesson
         st.session_state.last_tutorial_signature = sig
-        st.session_state.quiz = []
+        if st.session_state.quiz_future is not None:
+            st.session_state.quiz_future.cancel()
+            st.session_state.quiz_future = None
+        st.session_state.update(quiz_state())
         st.session_state.current_q = 0
         st.session_state.score = 0
-        st.session_state.hints_used = {}
+
+# -----------------
+# QUIZ CARD
+# -----------------
+def start_check(q_index):
+    # An empty answer makes no call; the Submit click just shows a warning.
+    if st.session_state[f"answer_{q_index}"].strip():
+        start_llm_call("check")
+
+def start_hint(q_index):
+    if st.session_state.hints_used[q_index] < 3:
+        start_llm_call("hint")
+
+@st.fragment
+def quiz_card():
+    """Render the current question; reruns triggered inside stay scoped to this card."""
+    q_index = st.session_state.current_q
+
+    if not st.session_state.quiz_q:
+        st.error("No quiz available. Go back to the tutorial.")
+    else:
+        total_q = len(st.session_state.quiz_q)
+        if q_index >= total_q:
+            st.success(f"✅ Quiz completed! Final Score: {st.session_state.score}/{total_q}")
+            if st.button("Restart"):
+                st.session_state.page = "home"
+                st.rerun()
+        else:
+            question = st.session_state.quiz_q[q_index]
+            reference_answer = st.session_state.quiz_a[q_index]
+            st.subheader(f"Question {q_index+1}: {question}")
+            st.info(f"Score: {st.session_state.score}/{total_q}")
+            hints_for_q = st.session_state.hints_used[q_index]
+
+            if st.session_state.quiz_feedback is None:
+                answer = st.text_input("Your answer:", key=f"answer_{q_index}")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    if st.button("Submit", key=f"submit_{q_index}", disabled=st.session_state.in_flight,
+                                 on_click=start_check, args=(q_index,)) and not answer.strip():
+                        st.warning("Please provide an answer before submitting.")
+                with col2:
+                    if st.button("Hint", key=f"hint_{q_index}", disabled=st.session_state.in_flight,
+                                 on_click=start_hint, args=(q_index,)) and hints_for_q >= 3:
+                        st.warning("⚠️ No more hints allowed for this question.")
+                with col3:
+                    st.write(f"Hints used: {hints_for_q}/3")
+                # Revealed hints live in session state so they survive the rerun that re-enables the buttons.
+                for i, hint_text in enumerate(st.session_state.quiz_hints[q_index][:hints_for_q], 1):
+                    st.info(f"💡 Hint {i}: {hint_text}")
+
+                if st.session_state.pending == "check":
+                    with handling_llm_call(scope="fragment"), st.spinner("Checking answer..."):
+                        is_correct, feedback = check_answer_with_llm(
+                            st.session_state.lesson, question, answer, reference_answer,
+                            None if st.session_state.quiz_emb is None else st.session_state.quiz_emb[q_index]
+                        )
+                        st.session_state.quiz_feedback = (is_correct, feedback)
+                        if is_correct:
+                            st.session_state.score += 1
+                elif st.session_state.pending == "hint":
+                    with handling_llm_call(scope="fragment"), st.spinner("Generating hint..."):
+                        hints = st.session_state.quiz_hints[q_index]
+                        if hints_for_q >= len(hints):
+                            hints.append(generate_hint(
+                                st.session_state.lesson, question, reference_answer, hints_for_q + 1
+                            ))
+                        st.session_state.hints_used[q_index] += 1
+            else:
+                is_correct, feedback = st.session_state.quiz_feedback
+                if is_correct:
+                    st.success("✅ Correct!")
+                else:
+                    st.error("❌ Incorrect!")
+                lines = feedback.strip().splitlines()
+                if len(lines) > 1:
+                    st.write("Feedback:", "\n".join(lines[1:]).strip())
+                if st.button("Next Question ➡"):
+                    st.session_state.current_q += 1
+                    st.session_state.quiz_feedback = None
+                    st.rerun(scope="fragment")
 
 # -----------------
 # HOME PAGE
 # -----------------
-if st.session_state.page == "home":
+def start_tutorial():
+    concept = st.session_state.concept_input.strip()
+    if concept:
+        st.session_state.subject = st.session_state.subject_input
+        st.session_state.concept = concept
+        st.session_state.page = "tutorial"
+        start_llm_call("tutorial")
+
+def render_home():
     st.title("📚 AI Learning Assistant")
     grade_option = st.selectbox("Select Grade", [f"Grade {i}" for i in range(1, 13)])
-    subject = st.selectbox("Select Subject", ["Physics", "Chemistry", "Biology", "Mathematics"])
-    concept = st.text_input("Enter the concept you want to study")
+    st.selectbox("Select Subject", ["Physics", "Chemistry", "Biology", "Mathematics"], key="subject_input")
+    st.text_input("Enter the concept you want to study", key="concept_input")
 
     try:
         st.session_state.difficulty_grade = int(grade_option.split()[1])
     except:
         st.session_state.difficulty_grade = 6
 
-    if st.button("Generate Tutorial") and concept.strip():
-        st.session_state.subject = subject
-        st.session_state.concept = concept.strip()
-        st.session_state.page = "tutorial"
-        st.rerun()
+    st.button("Generate Tutorial", disabled=st.session_state.in_flight, on_click=start_tutorial)
 
 # -----------------
 # TUTORIAL PAGE
 # -----------------
-elif st.session_state.page == "tutorial":
-    ensure_tutorial_uptodate()
+def change_grade(step):
+    grade = st.session_state.difficulty_grade + step
+    if 1 <= grade <= 12:
+        st.session_state.difficulty_grade = grade
+        start_llm_call("tutorial")
 
+def request_better_tutorial():
+    st.session_state.last_tutorial_signature = None
+    st.session_state.regenerate_tutorial = True
+    start_llm_call("tutorial")
+
+def render_tutorial():
     st.title("📖 Tutorial")
-    st.write(st.session_state.lesson or "No tutorial yet.")
+    lesson_area = st.empty()
 
+    # The controls render before the lesson is (re)generated below, so a regeneration they
+    # started streams in with them already disabled.
     col_left, col_mid, col_right = st.columns([1, 2, 1])
     with col_left:
-        if st.button("⬅ Easier"):
-            if st.session_state.difficulty_grade > 1:
-                st.session_state.difficulty_grade -= 1
-                st.rerun()
+        st.button("⬅ Easier", disabled=st.session_state.in_flight, on_click=change_grade, args=(-1,))
     with col_mid:
         st.markdown(f"**Difficulty (grade): Grade {st.session_state.difficulty_grade}**")
         st.progress(st.session_state.difficulty_grade / 12)
     with col_right:
-        if st.button("Harder ➡"):
-            if st.session_state.difficulty_grade < 12:
-                st.session_state.difficulty_grade += 1
-                st.rerun()
+        st.button("Harder ➡", disabled=st.session_state.in_flight, on_click=change_grade, args=(1,))
 
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("Understood, let's move to quiz"):
-            with st.spinner("Generating quiz questions..."):
-                quiz_text = ask_openrouter(
-                    "You are a careful examiner. Generate exactly 10 quiz questions ONLY (no answers in this step). "
-                    "CRITICAL RULES: Questions must be answerable directly and exclusively from the tutorial below; "
-                    "do not use outside knowledge; do not invent facts. "
-                    f"Context: Subject={st.session_state.subject}, Grade={st.session_state.difficulty_grade}, "
-                    f"Topic='{st.session_state.concept}'. "
-                    "Write each question on a new line without numbering.\n\n"
-                    "=== TUTORIAL START ===\n"
-                    f"{st.session_state.lesson}\n"
-                    "=== TUTORIAL END ==="
-                )
+        st.button("Understood, let's move to quiz", disabled=st.session_state.in_flight,
+                  on_click=start_llm_call, args=("quiz",))
+    with col2:
+        st.button("Give me a better tutorial", disabled=st.session_state.in_flight,
+                  on_click=request_better_tutorial)
 
-            with st.spinner("Generating answers for the quiz..."):
-                answers_text = ask_openrouter(
-                    "Provide concise, correct answers to the following quiz questions. "
-                    "CRITICAL RULES: Answers must be found verbatim or paraphrased from the tutorial below; "
-                    "do not use outside knowledge; if an answer cannot be derived strictly from the tutorial, reply with 'INSUFFICIENT'. "
-                    f"Context: Subject={st.session_state.subject}, Grade={st.session_state.difficulty_grade}, "
-                    f"Topic='{st.session_state.concept}'. "
-                    "One short answer per line, aligned with the questions order.\n\n"
-                    "=== TUTORIAL START ===\n"
-                    f"{st.session_state.lesson}\n"
-                    "=== TUTORIAL END ===\n\n"
-                    "=== QUESTIONS START ===\n"
-                    f"{quiz_text}\n"
-                    "=== QUESTIONS END ==="
-                )
+    ensure_tutorial_uptodate(lesson_area)
+    lesson_area.markdown(st.session_state.lesson or "No tutorial yet.")
 
-            q_lines = [strip_numbering(l) for l in quiz_text.splitlines() if l.strip()]
-            a_lines = [strip_numbering(l) for l in answers_text.splitlines() if l.strip()]
-            pairs = list(zip(q_lines, a_lines))
-            filtered = [{"question": q, "answer": a} for q, a in pairs if a.lower().strip() != "insufficient"]
+    # Speculatively build the quiz while the student reads the tutorial.
+    if st.session_state.quiz_future is None and st.session_state.lesson and API_ERROR not in st.session_state.lesson:
+        st.session_state.quiz_future = get_executor().submit(
+            prepare_quiz,
+            st.session_state.lesson,
+            st.session_state.subject,
+            st.session_state.difficulty_grade,
+            st.session_state.concept
+        )
 
-            st.session_state.quiz = filtered[:10]
-            st.session_state.current_q = 0
-            st.session_state.score = 0
-            st.session_state.hints_used = {}
-            st.session_state.page = "quiz"
-            st.session_state.quiz_feedback = None
-            st.rerun()
+    if st.session_state.pending == "quiz":
+        with st.spinner("Generating quiz..."):
+            future = st.session_state.quiz_future
+            quiz = None
+            if future is not None and future.cancel():
+                # Still queued behind other sessions' prefetches on the shared pool; building
+                # it here is quicker than waiting for a worker to free up.
+                future = st.session_state.quiz_future = None
+            if future is not None:
+                try:
+                    quiz = future.result()
+                except Exception:
+                    logger.exception("Quiz prefetch failed; building the quiz synchronously")
+            if not quiz or not quiz["quiz_q"]:
+                quiz = prepare_quiz(
+                    st.session_state.lesson,
+                    st.session_state.subject,
+                    st.session_state.difficulty_grade,
+                    st.session_state.concept
+                )
 
-    with col2:
-        if st.button("Give me a better tutorial"):
-            st.session_state.last_tutorial_signature = None
-            st.rerun()
+        st.session_state.update(quiz)
+        st.session_state.current_q = 0
+        st.session_state.score = 0
+        # A prefetched quiz can be reused after Restart, so start from fresh copies of the
+        # lists this session changes (hint counts, and live hints get appended).
+        st.session_state.hints_used = [0] * len(quiz["quiz_q"])
+        st.session_state.quiz_hints = [list(hints) for hints in quiz["quiz_hints"]]
+        st.session_state.page = "quiz"
+        st.session_state.quiz_feedback = None
 
 # -----------------
 # QUIZ PAGE
 # -----------------
-elif st.session_state.page == "quiz":
+def render_quiz():
     st.title("📝 Quiz Time")
-    q_index = st.session_state.current_q
+    quiz_card()
 
-    if not st.session_state.quiz:
-        st.error("No quiz available. Go back to the tutorial.")
-    else:
-        total_q = len(st.session_state.quiz)
-        if q_index >= total_q:
-            st.success(f"✅ Quiz completed! Final Score: {st.session_state.score}/{total_q}")
-            if st.button("Restart"):
-                st.session_state.page = "home"
-                st.rerun()
-        else:
-            q_data = st.session_state.quiz[q_index]
-            st.subheader(f"Question {q_index+1}: {q_data['question']}")
-            st.info(f"Score: {st.session_state.score}/{total_q}")
-            hints_for_q = st.session_state.hints_used.get(str(q_index), 0)
-
-            if st.session_state.quiz_feedback is None:
-                answer = st.text_input("Your answer:", key=f"answer_{q_index}")
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    if st.button("Submit", key=f"submit_{q_index}"):
-                        if not answer.strip():
-                            st.warning("Please provide an answer before submitting.")
-                        else:
-                            with st.spinner("Checking answer..."):
-                                is_correct, feedback = check_answer_with_llm(q_data["question"], answer)
-                            st.session_state.quiz_feedback = (is_correct, feedback)
-                            if is_correct:
-                                st.session_state.score += 1
-                            st.rerun()
-                with col2:
-                    if st.button("Hint", key=f"hint_{q_index}"):
-                        if hints_for_q >= 3:
-                            st.warning("⚠️ No more hints allowed for this question.")
-                        else:
-                            with st.spinner("Generating hint..."):
-                                hint_text = generate_hint(q_data["question"], q_data.get("answer", ""))
-                            st.session_state.hints_used[str(q_index)] = hints_for_q + 1
-                            st.info(f"💡 Hint {st.session_state.hints_used[str(q_index)]}: {hint_text}")
-                with col3:
-                    st.write(f"Hints used: {hints_for_q}/3")
-            else:
-                is_correct, feedback = st.session_state.quiz_feedback
-                if is_correct:
-                    st.success("✅ Correct!")
-                else:
-                    st.error("❌ Incorrect!")
-                lines = feedback.strip().splitlines()
-                if len(lines) > 1:
-                    st.write("Feedback:", "\n".join(lines[1:]).strip())
-                if st.button("Next Question ➡"):
-                    st.session_state.current_q += 1
-                    st.session_state.quiz_feedback = None
-                    st.rerun()
+# -----------------
+# PAGE DISPATCH
+# -----------------
+PAGES = {
+    "home": render_home,
+    "tutorial": render_tutorial,
+    "quiz": render_quiz
+}
+if st.session_state.in_flight:
+    # This run handles a flagged click and renders its trigger buttons disabled; once the
+    # page has made the call (or it was served from cache), bring them back.
+    with handling_llm_call():
+        PAGES[st.session_state.page]()
+else:
+    PAGES[st.session_state.page]()